@@ -2,6 +2,7 @@
 Optional schema to provide URLs to the main volume schema.
 """
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import datajoint as dj
 
@@ -74,15 +75,18 @@ class BossDBURLs(dj.Lookup):
         master_key = dict(collection_experiment=collection_experiment)
         base_url = f"bossdb://{collection_experiment}/"
         vol_url = base_url + volume
-        seg_url = base_url + segmentation
-        con_url = base_url + connectome
+        seg_url = base_url + segmentation if segmentation else None
+        con_url = base_url + connectome if connectome else None
 
         if test_exists:
-            for url in [vol_url, seg_url, con_url]:
-                if url != base_url and not BossDBInterface(url).exists:
-                    logger.warning(
-                        f"The following BossDB url does not yet exist: {url}"
-                    )
+            urls = [url for url in (vol_url, seg_url, con_url) if url]
+            # Each check is a network round trip, so run them concurrently
+            with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+                for url, data in zip(urls, executor.map(BossDBInterface, urls)):
+                    if not data.exists:
+                        logger.warning(
+                            f"The following BossDB url does not yet exist: {url}"
+                        )
 
         with cls.connection.transaction:
             cls.insert1(master_key, skip_duplicates=skip_duplicates)
@@ -91,12 +95,12 @@ class BossDBURLs(dj.Lookup):
                 {**master_key, "url": vol_url},
                 skip_duplicates=skip_duplicates,
             )
-            if segmentation:
+            if seg_url:
                 cls.Segmentation.insert1(
                     {**master_key, "url": seg_url},
                     skip_duplicates=skip_duplicates,
                 )
-            if connectome:
+            if con_url:
                 cls.Connectome.insert1(
                     {**master_key, "url": con_url},
                     skip_duplicates=skip_duplicates,
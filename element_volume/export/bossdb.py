@@ -1,4 +1,12 @@
+import functools
+import heapq
 import logging
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from typing import Optional, Tuple
 
 import numpy as np
@@ -19,6 +27,87 @@ from ..readers.bossdb import BossDBInterface
 
 logger = logging.getLogger("datajoint")
 
+# Depth of BossDB's fixed storage cuboids (512 x 512 x 16 in X, Y, Z)
+BOSSDB_CUBOID_Z = 16
+
+# Shared pool for decoding image slices. Decoders release the GIL while decoding.
+_decode_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Optional faster decoders, used in place of Pillow when installed
+try:
+    import pyspng
+except ImportError:
+    pyspng = None
+
+try:
+    from turbojpeg import TJPF_GRAY, TurboJPEG
+
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError):  # RuntimeError if libturbojpeg is not found
+    _turbo_jpeg = None
+
+
+def _decode_image(path: Path) -> np.ndarray:
+    # Decodes in the file's native dtype. Callers cast by assigning into their buffer.
+    suffix = path.suffix.lower()
+    if pyspng is not None and suffix == ".png":
+        image = pyspng.load(path.read_bytes())
+        # pyspng returns 16-bit grayscale as (H, W, 2); keep the gray channel only
+        return image[..., 0] if image.ndim == 3 and image.shape[-1] <= 2 else image
+    if _turbo_jpeg is not None and suffix in (".jpg", ".jpeg"):
+        return _turbo_jpeg.decode(path.read_bytes(), pixel_format=TJPF_GRAY)[..., 0]
+    with Image.open(path) as image:
+        return np.asarray(image)
+
+
+def _prefetch_files(paths) -> None:
+    # Hint the kernel to start reading files ahead of decoding them (POSIX only)
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue  # surfaced later when the file is decoded
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def _memmap_stack(path: Path) -> np.ndarray:
+    # Memory-map a single-file (Z, Y, X) stack, so increments are read from disk lazily
+    if path.suffix.lower() == ".npy":
+        return np.load(path, mmap_mode="r")
+    if path.suffix.lower() in (".tif", ".tiff"):
+        import tifffile  # isort: skip
+
+        return tifffile.memmap(path, mode="r")  # uncompressed, contiguous TIFFs only
+    raise DataJointError(f"Unsupported volume file type: {path}")
+
+
+def _natural_key(name: str) -> tuple:
+    # Compare digit runs as numbers so that e.g. Z10.png sorts after Z9.png
+    return tuple(int(s) if s.isdigit() else s for s in re.split(r"(\d+)", name))
+
+
+@functools.lru_cache(maxsize=8)
+def _list_images(
+    data_dir: str, data_extension: str, mtime_ns: int, n_images: int
+) -> tuple:
+    # mtime_ns is only part of the cache key: adding or removing files invalidates it
+    with os.scandir(data_dir) as entries:  # DirEntry caches file type, no extra stat
+        names = [
+            entry.name
+            for entry in entries
+            if entry.is_file()
+            and not entry.name.startswith(".")
+            and entry.name.endswith(data_extension)
+        ]
+    # Only the first n_images are uploaded: partial sort, O(n log k) vs O(n log n)
+    first_names = heapq.nsmallest(n_images, names, key=_natural_key)
+    return tuple(Path(data_dir) / name for name in first_names)
+
 
 class BossDBUpload:
     def __init__(
@@ -29,11 +118,14 @@ class BossDBUpload:
         voxel_units: str,  # The size units of a voxel
         shape_zyx: Tuple[int, int, int],
         resolution: int = 0,
-        raw_data: np.array = None,
+        raw_data: np.array = None,  # Or array-like sliced along Z: memmap, zarr, h5py
         data_extension: Optional[str] = "",  # Can omit if uploading every file in dir
         upload_increment: Optional[int] = 16,  # How many z slices to upload at once
+        upload_batch: Optional[int] = 1,  # How many increments to send per request
         retry_max: Optional[int] = 3,  # Number of retries to upload a single
+        max_inflight: Optional[int] = 1,  # How many requests to BossDB at once
         dtype: Optional[str] = None,  # type of the image data. e.g., uint8, uint64
+        hierarchy_levels: Optional[int] = 1,  # Resolutions BossDB downsamples to
         overwrite: Optional[bool] = False,  # Overwrite existing data
     ):
         # TODO: Move comments to full docstring
@@ -52,10 +144,22 @@ class BossDBUpload:
         self._raw_data = raw_data
         self._data_extension = data_extension
         self._upload_increment = upload_increment
+        self._upload_batch = upload_batch
+        # Coalesce increments to amortize per-request overhead on small Y*X volumes
+        self._chunk_size = upload_increment * upload_batch
+        if self._chunk_size % BOSSDB_CUBOID_Z:
+            logger.warning(
+                f"Uploading {self._chunk_size} z slices per request splits BossDB's "
+                + f"{BOSSDB_CUBOID_Z}-slice cuboids across requests. For best "
+                + f"performance, use a multiple of {BOSSDB_CUBOID_Z}."
+            )
         self._retry_max = retry_max
+        self._max_inflight = max_inflight
         self._overwrite = overwrite
+        self._hierarchy_levels = hierarchy_levels
         self.description = "Uploaded via DataJoint"
         self._resources = dict()
+        self._dataset = None
 
         self.url_exists = BossDBInterface(self._url).exists
         if not overwrite and self.url_exists:
@@ -65,26 +169,60 @@ class BossDBUpload:
             )
             return
 
+        if self._raw_data is None and data_dir and Path(data_dir).is_file():
+            self._raw_data = _memmap_stack(Path(data_dir))
+            if self._raw_data.shape != self._shape_zyx:
+                raise ValueError(
+                    f"volume_data shape {self._raw_data.shape} does not match the "
+                    + f"(Z, Y, X) size {self._shape_zyx} of this volume."
+                )
+
+        # Set before creating the channel, whose datatype is taken from it
+        if self._raw_data is None:  # 'is None' bc np.array as ambiguous truth value
+            self._dtype = dtype
+        else:
+            self._dtype = self._raw_data.dtype if dtype is None else dtype
+
         if not self.url_exists:
             self.try_create_new()
 
-        if self._raw_data is None:  # 'is None' bc np.array as ambiguous truth value
+        if self._raw_data is None:
             self._image_paths = self.fetch_images()
-            self._dtype = dtype or None
-        else:
-            self._dtype = dtype or self._raw_data.dtype
+            # Large slices can exceed Pillow's decompression bomb limit. Raise it only
+            # as far as the declared slice size rather than disabling the check.
+            slice_pixels = self._shape_zyx[1] * self._shape_zyx[2]
+            if Image.MAX_IMAGE_PIXELS and slice_pixels > Image.MAX_IMAGE_PIXELS:
+                Image.MAX_IMAGE_PIXELS = slice_pixels
 
     def fetch_images(self):
-        image_paths = sorted(self._data_dir.glob("*" + self._data_extension))
+        data_dir = str(self._data_dir)
+        image_paths = _list_images(
+            data_dir,
+            self._data_extension,
+            os.stat(data_dir).st_mtime_ns,
+            self._shape_zyx[0],
+        )
         if not image_paths:
             raise DataJointError(
                 "No files found in the specified directory "
                 + f"{self._data_dir}/*{self._data_extension}."
             )
+        if len(image_paths) < self._shape_zyx[0]:
+            raise DataJointError(
+                f"Found {len(image_paths)} files in {self._data_dir}/*"
+                + f"{self._data_extension}, but the volume has {self._shape_zyx[0]} "
+                + "z slices. Uploading assumes 1 image per z slice."
+            )
         return image_paths
 
     @property
     def dataset(self):
+        # Cached: each BossDBInterface init issues metadata requests to BossDB
+        if self._dataset is None:
+            self._dataset = self._new_dataset()
+        return self._dataset
+
+    def _new_dataset(self):
         return BossDBInterface(
             self._url,
             extents=self._shape_zyx,
@@ -100,52 +238,120 @@ class BossDBUpload:
 
     def upload(self):
         z_max = self._shape_zyx[0]
-        for i in tqdm(range(0, z_max, self._upload_increment)):
-            # whichever smaller increment or end
-            z_limit = min(i + self._upload_increment, z_max)
-
-            stack = (
-                self._raw_data[i:z_limit]
-                if self._raw_data is not None
-                else self._np_from_images(i, z_limit)
+        # One reusable buffer per in-flight request, plus one being decoded into
+        n_buffers = self._max_inflight + 1
+        buffers = (
+            [
+                np.empty(
+                    (min(self._chunk_size, z_max), *self._shape_zyx[1:]),
+                    dtype=self._dtype,
+                )
+                for _ in range(n_buffers)
+            ]
+            if not self._raw_is_contiguous
+            else [None] * n_buffers  # C-contiguous slices are uploaded as views
+        )
+        _ = self.dataset  # create the shared handle before starting upload threads
+        # Decode the next increment while up to max_inflight increments upload
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=self._max_inflight) as uploader:
+            for n, i in enumerate(tqdm(range(0, z_max, self._chunk_size))):
+                # Decoded while the previous increments are still uploading. This
+                # buffer's last upload, increment n - n_buffers, was already awaited.
+                stack = self._load_stack(i, buffers[n % n_buffers])
+                if len(in_flight) == self._max_inflight:
+                    in_flight.popleft().result()
+                in_flight.append(uploader.submit(self._upload_stack, i, stack))
+                if self._raw_data is None:  # read ahead while this increment uploads
+                    next_i = i + self._chunk_size
+                    _prefetch_files(
+                        self._image_paths[next_i : next_i + self._chunk_size]
+                    )
+            for future in in_flight:
+                future.result()
+
+    def _load_stack(self, i, out=None):
+        # whichever smaller increment or end
+        z_limit = min(i + self._chunk_size, self._shape_zyx[0])
+
+        if self._raw_data is None:
+            return self._np_from_images(i, z_limit, out)
+
+        if self._raw_is_contiguous:
+            return self._raw_data[i:z_limit]
+
+        # Lazy array-likes only read this increment; strided arrays copy it once
+        stack = np.asarray(self._raw_data[i:z_limit])
+        self._check_cast(stack, i)
+        if out is None:
+            return np.ascontiguousarray(stack, dtype=self._dtype)
+        out = out[: z_limit - i]  # tail increment may be shorter than the buffer
+        out[...] = stack
+        return out
+
+    def _check_cast(self, stack, i):
+        # Narrowing casts would silently wrap values that do not fit the upload dtype
+        if (
+            not stack.size
+            or np.can_cast(stack.dtype, self._dtype)
+            or not np.issubdtype(self._dtype, np.integer)
+        ):
+            return
+        dtype_info = np.iinfo(self._dtype)
+        if stack.min() < dtype_info.min or stack.max() > dtype_info.max:
+            raise ValueError(
+                f"Values in z slices {i}-{i + stack.shape[0]} do not fit in "
+                + f"{np.dtype(self._dtype)}."
             )
 
-            if not stack.flags["C_CONTIGUOUS"]:
-                stack = np.ascontiguousarray(stack)
-
-            stack_shape = stack.shape
-
-            retry_count = 0
-
-            while True:
-                try:
-                    self.dataset[
-                        i : i + stack_shape[0],
-                        0 : stack_shape[1],
-                        0 : stack_shape[2],
-                    ] = stack
-                    break
-                except Exception as e:
-                    logger.error(f"Error uploading chunk {i}-{i + stack_shape[0]}: {e}")
-                    retry_count += 1
-                    if retry_count > self._retry_max:
-                        raise e
-                    logger.info(
-                        f"Retrying increment {i}...{retry_count}/{self._retry_max}"
-                    )
-                    continue
+    @property
+    def _raw_is_contiguous(self):
+        # Views are only uploaded as-is if they already have the upload dtype
+        return (
+            isinstance(self._raw_data, np.ndarray)
+            and self._raw_data.flags["C_CONTIGUOUS"]
+            and self._raw_data.dtype == self._dtype
+        )
+
+    def _upload_stack(self, i, stack):
+        stack_shape = stack.shape
+
+        retry_count = 0
+
+        while True:
+            try:
+                self.dataset[
+                    i : i + stack_shape[0],
+                    0 : stack_shape[1],
+                    0 : stack_shape[2],
+                ] = stack
+                break
+            except Exception as e:
+                logger.error(f"Error uploading chunk {i}-{i + stack_shape[0]}: {e}")
+                retry_count += 1
+                if retry_count > self._retry_max:
+                    raise e
+                logger.info(f"Retrying increment {i}...{retry_count}/{self._retry_max}")
+                time.sleep(2 ** (retry_count - 1))  # back off before retrying
+                continue
         # 'Create cutout failed on CalciumImaging, got HTTP response: (400) - {"status":
         # 400, "code": 2002, "message": "Failed to unpack data. Verify the datatype of
         # your POSTed data and xyz dimensions used in the POST URL."}'
 
-    def _np_from_images(self, i, z_limit):
-        return np.stack(
-            [
-                np.array(image, dtype=self._dtype)
-                for image in [Image.open(path) for path in self._image_paths[i:z_limit]]
-            ],
-            axis=0,
-        )
+    def _np_from_images(self, i, z_limit, out=None):
+        if out is None:
+            out = np.empty((z_limit - i, *self._shape_zyx[1:]), dtype=self._dtype)
+        out = out[: z_limit - i]  # tail increment may be shorter than the buffer
+
+        def _load_one(k, path):
+            out[k] = _decode_image(Path(path))  # fused cast and copy, no temporary
+
+        # Exhaust the iterator so that any decoding error is raised here
+        for _ in _decode_executor.map(
+            _load_one, range(z_limit - i), self._image_paths[i:z_limit]
+        ):
+            pass
+        return out
 
     @property
     def resources(self):
@@ -174,6 +380,8 @@ class BossDBUpload:
                     collection_name=self.url_bits.collection,
                     coord_frame=coord_name,
                     description=self.description,
+                    num_hierarchy_levels=self._hierarchy_levels,
+                    hierarchy_method="anisotropic",  # halve X and Y, keep Z
                 ),
                 channel_resource=ChannelResource(
                     name=self.url_bits.channel,
@@ -219,6 +427,19 @@ class BossDBUpload:
         channel.sources = [channel_resource.name]
         _ = self._get_or_create(remote=remote, obj=channel)
 
+    def downsample(self):
+        # BossDB only accepts cutout writes at the base resolution and builds lower
+        # resolutions with its own downsample service, started here after upload
+        remote = BossRemote()
+        service = remote.project_service
+        response = service.session.post(
+            f"{service.url_prefix}/v1/downsample/{self.url_bits.collection}/"
+            + f"{self.url_bits.experiment}/{self.url_bits.channel}/",
+            headers={"Authorization": f"Token {remote.token_project}"},
+        )
+        response.raise_for_status()
+        logger.info(f"Started BossDB downsample of {self._url}")
+
     def _get_or_create(self, remote, obj):
         try:
             result = remote.get_project(obj)
@@ -1,8 +1,12 @@
+import hashlib
 import logging
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, Tuple, Union
 
+import datajoint as dj
 import numpy as np
 from element_interface.utils import find_full_path
 from intern import array
@@ -16,6 +20,48 @@ from ..bossdb import BossDBURLs
 logger = logging.getLogger("datajoint")
 
 
+def _cutout_cache_dir() -> Optional[Path]:
+    # Optional local cache of downloaded cutouts, e.g.
+    # dj.config["stores"]["bossdb_cache"] = dict(protocol="file", location="/tmp/x")
+    store = dj.config.get("stores", {}).get("bossdb_cache")
+    return Path(store["location"]) if store else None
+
+
+def _compact_labels(data: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    # Replace labels with indices into a palette of unique labels, stored in the
+    # narrowest dtype that fits. Returns (data, None) if that would not be smaller.
+    if not np.issubdtype(data.dtype, np.integer) or not data.size:
+        return data, None
+    palette, inverse = np.unique(data, return_inverse=True)
+    if palette[0] < 0:
+        return data, None
+    if palette[0] != 0:  # index 0 stays background even if no voxel is labeled 0
+        palette = np.concatenate([np.zeros(1, dtype=palette.dtype), palette])
+        inverse = inverse + 1
+    dtype = next(
+        np.dtype(d)
+        for d in ("uint8", "uint16", "uint32", "uint64")
+        if palette.size - 1 <= np.iinfo(d).max
+    )
+    if dtype.itemsize >= data.dtype.itemsize:
+        return data, None
+    return inverse.reshape(data.shape).astype(dtype), palette
+
+
+def _contiguous_copy(data: np.ndarray, tile: int = 64) -> np.ndarray:
+    # Copy a strided 3D view (e.g., swapped axes) in tiles, so that the source and
+    # destination blocks of each step stay in cache instead of striding the volume
+    if data.ndim != 3:
+        return np.ascontiguousarray(data)
+    out = np.empty(data.shape, dtype=data.dtype)
+    for z in range(0, data.shape[0], tile):
+        for y in range(0, data.shape[1], tile):
+            for x in range(0, data.shape[2], tile):
+                block = (slice(z, z + tile), slice(y, y + tile), slice(x, x + tile))
+                out[block] = data[block]
+    return out
+
+
 class BossDBInterface(array):
     def __init__(
         self,
@@ -37,6 +83,13 @@ class BossDBInterface(array):
 
         self._session_key = session_key or dict()
 
+        # Cache axis order lookups, as ZYX
+        self._z_first = self.axis_order[0] == "Z"
+        self._shape_zyx = tuple(self.shape if self._z_first else self.shape[::-1])
+        self._voxel_size_zyx = tuple(
+            self.voxel_size if self._z_first else self.voxel_size[::-1]
+        )
+
         # If not passed resolution or volume IDs, use the following defaults:
         self._volume_key = dict(
             volume_id=volume_id or self.collection_name + "/" + self.experiment_name,
@@ -60,9 +113,9 @@ class BossDBInterface(array):
             dict(
                 resolution_id=self.resolution,  # integer 0-6
                 voxel_unit=self.voxel_unit,  # axis order is either ZYX or XYZ
-                voxel_z_size=self.voxel_size[0 if self.axis_order[0] == "Z" else 2],
-                voxel_y_size=self.voxel_size[1],
-                voxel_x_size=self.voxel_size[2 if self.axis_order[0] == "Z" else 0],
+                voxel_z_size=self._voxel_size_zyx[0],
+                voxel_y_size=self._voxel_size_zyx[1],
+                voxel_x_size=self._voxel_size_zyx[2],
             ),
             skip_duplicates=skip_duplicates,
         )
@@ -72,9 +125,9 @@ class BossDBInterface(array):
             dict(
                 **self._session_key,
                 **self._volume_key,
-                z_size=self.shape[0 if self.axis_order[0] == "Z" else 2],
-                y_size=self.shape[1],
-                x_size=self.shape[2 if self.axis_order[0] == "Z" else 0],
+                z_size=self._shape_zyx[0],
+                y_size=self._shape_zyx[1],
+                x_size=self._shape_zyx[2],
                 channel=self.channel_name,
                 collection_experiment=f"{self.collection_name}_{self.experiment_name}",
                 url=f"bossdb://{self._channel.get_cutout_route()}",
@@ -84,30 +137,41 @@ class BossDBInterface(array):
         )
 
     def _import_segmentation(self, data: np.ndarray = None, skip_duplicates=True):
+        palette = None
+        if data is not None:
+            data, palette = _compact_labels(data)
+        # A skipped duplicate keeps its stored data, which a new palette would not fit
+        existing = bool(volume.Segmentation & self._volume_key)
         volume.Segmentation.insert1(
             dict(**self._volume_key, segmentation_data=data),
             skip_duplicates=skip_duplicates,
             allow_direct_insert=True,
         )
+        if palette is not None and not existing:
+            volume.Segmentation.LabelPalette.insert1(
+                dict(**self._volume_key, palette=palette),
+                skip_duplicates=skip_duplicates,
+                allow_direct_insert=True,
+            )
 
     def _string_to_slice_key(self, string_key: str) -> Tuple:
-        output = tuple()
+        output = []
         items = string_key.strip("[]").split(",")
         for index, item in enumerate(items):
             if item == ":":  # select all for dimension
                 start, stop = (0, self.shape[index])
             elif ":" in item:  # select slice of dimension
-                start, stop = list(map(int, item.split(":")))
+                start, stop = map(int, item.split(":"))
             else:  # select a single slice
                 start = int(item)
                 stop = start + 1
-            output = (*output, slice(start, stop))
+            output.append(slice(start, stop))
         if len(output) == 1:  # If only on dimension provided, assume Z
-            if self.axis_order[0] == "Z":
-                return (output[0], slice(0, self.shape[1]), slice(0, self.shape[1]))
+            if self._z_first:
+                return (output[0], slice(0, self.shape[1]), slice(0, self.shape[2]))
             else:
                 return (slice(0, self.shape[0]), slice(0, self.shape[1]), output[0])
-        return output
+        return tuple(output)
 
     def _slice_key_to_string(self, slice_key: Tuple[Union[int, slice]]) -> str:
         outputs = []
@@ -143,12 +207,87 @@ class BossDBInterface(array):
         if len(data.shape) == 2:  # getitem returned single z-slice
             data = data[np.newaxis, :]
 
-        for z in range(zs[0], zs[1]):
+        # Fastest zlib level: PNG writes are dominated by compression search otherwise
+        save_kwargs = dict(compress_level=1) if extension.lower() == ".png" else dict()
+
+        def _save_one(z):
             # Z is used as absolute reference within dataset.
             # When saving data, 0-indexed based on slices fetched
-            Image.fromarray(data[z - zs[0]], mode=image_mode).save(file_path_full % z)
+            Image.fromarray(data[z - zs[0]], mode=image_mode).save(
+                file_path_full % z, **save_kwargs
+            )
+
+        # Encoding releases the GIL, so slices are written in parallel
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for _ in executor.map(_save_one, range(zs[0], zs[1])):
+                pass  # exhaust the iterator so that any write error is raised here
         logger.info(f"Saved Z-slices {zs[0]} to {zs[1]}:\n{file_path}/")
 
+    def _fetch_cutout(
+        self,
+        slice_key: Tuple[slice],
+        max_workers: int = 1,
+        refresh_cache: bool = False,
+    ):
+        cache_dir = _cutout_cache_dir()
+        if cache_dir is None or not all(isinstance(s, slice) for s in slice_key):
+            return self._download_cutout(slice_key, max_workers)
+
+        cutout_id = hashlib.md5(
+            repr(
+                (
+                    self._channel.get_cutout_route(),
+                    self.resolution,
+                    [(s.start, s.stop) for s in slice_key],
+                )
+            ).encode()
+        ).hexdigest()
+        cache_path = cache_dir / f"{cutout_id}.npy"
+        if cache_path.exists() and not refresh_cache:
+            return np.load(cache_path, mmap_mode="r")
+
+        data = self._download_cutout(slice_key, max_workers)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # Unique temporary file, renamed so that readers never see a partial file
+        with tempfile.NamedTemporaryFile(
+            dir=cache_dir, suffix=".tmp", delete=False
+        ) as f:
+            np.save(f, data)
+        os.replace(f.name, cache_path)
+        return data
+
+    def _download_cutout(self, slice_key: Tuple[slice], max_workers: int = 1):
+        if (
+            max_workers <= 1
+            or len(slice_key) != len(self.shape)
+            or not all(isinstance(s, slice) for s in slice_key)
+        ):
+            return self.__getitem__(key=slice_key)
+
+        # Resolve open bounds, e.g. slice(None), against the channel's extents
+        bounds = [s.indices(size) for s, size in zip(slice_key, self.shape)]
+        if any(step != 1 or stop <= start for start, stop, step in bounds):
+            return self.__getitem__(key=slice_key)
+        slice_key = tuple(slice(start, stop) for start, stop, _ in bounds)
+
+        # Split the first axis into one slab per worker. Cutout requests are network
+        # bound, so the slabs download concurrently and are joined in order.
+        first, *rest = slice_key
+        rest_shape = tuple(s.stop - s.start for s in rest)
+        step = -(-(first.stop - first.start) // max_workers)  # ceiling division
+        slab_keys = [
+            (slice(start, min(start + step, first.stop)), *rest)
+            for start in range(first.start, first.stop, step)
+        ]
+
+        def _fetch_one(slab_key):
+            # Single-slice cutouts may be squeezed; restore the slab's full shape
+            slab_shape = (slab_key[0].stop - slab_key[0].start, *rest_shape)
+            return np.reshape(self.__getitem__(key=slab_key), slab_shape)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return np.concatenate(list(executor.map(_fetch_one, slab_keys)), axis=0)
+
     def insert_channel_as_url(self, data_channel="Volume", skip_duplicates=True):
         collection_key = dict(
             collection_experiment=self.collection_name + "_" + self.experiment_name
@@ -171,6 +310,8 @@ class BossDBInterface(array):
         extension: str = ".png",
         skip_duplicates=False,
         image_mode=None,
+        max_workers: int = 1,  # Number of concurrent cutout requests
+        refresh_cache: bool = False,  # Re-download cached cutouts, e.g. after upload
     ):
         # NOTE: By accepting a slice here, we could download pngs and/or store ndarrays
         # that are a subset of the full volume with x and y start/stop limits. These
@@ -181,7 +322,15 @@ class BossDBInterface(array):
         if isinstance(slice_key, str):
             slice_key = self._string_to_slice_key(slice_key)
 
-        data = self.__getitem__(key=slice_key) if save_images or save_ndarray else None
+        data = (
+            self._fetch_cutout(slice_key, max_workers, refresh_cache)
+            if save_images or save_ndarray
+            else None
+        )
+        if data is not None and not data.flags["C_CONTIGUOUS"]:
+            # Cutouts of XYZ channels come back as swapped-axes views. Copy once here
+            # so that per-slice image writes and blob packing read contiguous rows.
+            data = _contiguous_copy(data)
 
         if (
             save_images
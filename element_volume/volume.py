@@ -2,16 +2,13 @@ import importlib
 import inspect
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import List, NamedTuple, Optional, Union
 
 import datajoint as dj
 import numpy as np
 from element_interface.utils import dict_to_uuid, find_full_path
 from numpy.typing import DTypeLike
 
-from .export.bossdb import BossDBUpload
-from .readers.bossdb import BossDBInterface
-
 logger = logging.getLogger("datajoint")
 
 schema = dj.Schema()
@@ -137,36 +134,126 @@ class Volume(dj.Manual):
         session_key: Optional[dict] = None,
         **kwargs,
     ):
+        from .readers.bossdb import BossDBInterface  # isort: skip
+
         data = BossDBInterface(url, resolution=downsampling, session_key=session_key)
         data.insert_channel_as_url(data_channel="Volume")
         data.load_data_into_element(**kwargs)
 
     @classmethod
     def return_bossdb_data(self, volume_key: dict):
-        url, res_id = (Volume & volume_key).fetch1("url", "resolution_id")
-        downsampling = (Resolution & dict(resolution_id=res_id)).fetch("downsampling")
-        return BossDBInterface(url, resolution=downsampling)
+        from .readers.bossdb import BossDBInterface  # isort: skip
+
+        meta = _fetch_volume_meta(volume_key)
+        return BossDBInterface(meta.url, resolution=meta.downsampling)
+
+    @classmethod
+    def data(cls, volume_key: dict):
+        """Returns the volume as an array, fetching lazily where possible.
+
+        Args:
+            volume_key (dict): A primary key of the Volume table.
+
+        Returns:
+            For volumes with a BossDB url, a BossDBInterface that downloads only the
+                indexed cutout, e.g. data[z0:z1]. Otherwise, the stored volume_data.
+        """
+        from .readers.bossdb import BossDBInterface  # isort: skip
+
+        meta = _fetch_volume_meta(volume_key)
+        if meta.url:
+            return BossDBInterface(meta.url, resolution=meta.downsampling)
+        return (cls & volume_key).fetch1("volume_data")
 
     @classmethod
     def upload(
         cls,
-        volume_key: dict,
+        volume_key: Union[dict, List[dict]],
         session_key: Optional[dict] = None,
         upload_from: Optional[str] = "table",
         data_dir: Optional[str] = None,
         dtype: Optional[DTypeLike] = None,
+        narrow_dtype: Optional[bool] = False,
+        pyramid_levels: Optional[int] = 1,
         **kwargs,
     ):
         # NOTE: uploading from data_dir (local rel path) assumes 1 image per z slice
-        # If not upload_from 'table', upload files in data_dir
+        # If not upload_from 'table', upload files in data_dir. data_dir may also be
+        #   a single .npy or uncompressed .tif (Z, Y, X) stack, which is memory-mapped
+        # narrow_dtype: when uploading from table without a dtype, use the smallest
+        #   dtype that holds every value (e.g., uint64 labels < 2**16 -> uint16)
+        # volume_key may be a list of keys to upload several volumes from table
+        # pyramid_levels: number of resolutions for BossDB to build after upload,
+        #   each halving Y and X of the previous. BossDB averages image channels.
+
+        if narrow_dtype and dtype is not None:
+            raise ValueError("Specify either dtype or narrow_dtype, not both")
+
+        if isinstance(volume_key, dict):
+            meta = _fetch_volume_meta(volume_key)
+            volume_metas = [(volume_key, meta)]
+        else:
+            if upload_from != "table":
+                raise ValueError("Multiple volumes can only be uploaded from table")
+            # One query for the metadata of all volumes
+            keys, *values = (cls * Resolution & volume_key).fetch(
+                "KEY", *_VolumeMeta._fields
+            )
+            volume_metas = [
+                (key, _VolumeMeta(*meta)) for key, meta in zip(keys, zip(*values))
+            ]
+
+        for key, meta in volume_metas:
+            cls._upload_volume(
+                key,
+                meta,
+                session_key=session_key,
+                upload_from=upload_from,
+                data_dir=data_dir,
+                dtype=dtype,
+                narrow_dtype=narrow_dtype,
+                pyramid_levels=pyramid_levels,
+                **kwargs,
+            )
+
+    @classmethod
+    def _upload_volume(
+        cls,
+        volume_key: dict,
+        meta: "_VolumeMeta",
+        session_key: Optional[dict] = None,
+        upload_from: Optional[str] = "table",
+        data_dir: Optional[str] = None,
+        dtype: Optional[DTypeLike] = None,
+        narrow_dtype: Optional[bool] = False,
+        pyramid_levels: Optional[int] = 1,
+        **kwargs,
+    ):
+        from .export.bossdb import BossDBUpload  # isort: skip
 
         if upload_from == "table":
+            # A longblob can only be fetched whole. For volumes larger than memory,
+            # upload from files instead, which are read one increment at a time
             data = (Volume & volume_key).fetch1("volume_data")
-            dtype = dtype or data.dtype  # if provided, fetch from
+            dtype = data.dtype if dtype is None else dtype  # if provided, fetch from
+            if (
+                narrow_dtype
+                and np.issubdtype(data.dtype, np.integer)
+                and data.min() >= 0
+            ):
+                data_max = data.max()
+                narrowest = next(
+                    np.dtype(d)
+                    for d in ("uint8", "uint16", "uint32", "uint64")
+                    if data_max <= np.iinfo(d).max
+                )
+                if narrowest.itemsize < data.dtype.itemsize:
+                    data = data.astype(narrowest)
+                    dtype = narrowest
         else:  # Uploading from image files
             data = None
 
-            if not dtype:
+            if dtype is None:
                 raise ValueError("Must specify dtype when loading data from images")
 
             if not data_dir and session_key:
@@ -179,7 +266,7 @@ class Volume(dj.Manual):
 
         if isinstance(dtype, str):
             dtype = np.dtype(dtype)
-        if dtype and dtype not in [np.dtype("uint8"), np.dtype("uint16")]:
+        if dtype is not None and dtype not in [np.dtype("uint8"), np.dtype("uint16")]:
             raise ValueError("BossDB only accepts uint8 or uint16 image data.")
 
         (
@@ -192,17 +279,13 @@ class Volume(dj.Manual):
             voxel_y_size,
             voxel_x_size,
             voxel_unit,
-        ) = (Volume * Resolution & volume_key).fetch1(
-            "url",
-            "downsampling",
-            "z_size",
-            "y_size",
-            "x_size",
-            "voxel_z_size",
-            "voxel_y_size",
-            "voxel_x_size",
-            "voxel_unit",
-        )
+        ) = meta
+
+        if data is not None and data.shape != (z_size, y_size, x_size):
+            raise ValueError(
+                f"volume_data shape {data.shape} does not match the (Z, Y, X) size "
+                + f"{(z_size, y_size, x_size)} of this volume."
+            )
 
         bossdb = BossDBUpload(
             url=url,
@@ -213,9 +296,29 @@ class Volume(dj.Manual):
             shape_zyx=(int(i) for i in (z_size, y_size, x_size)),
             resolution=downsampling,
             dtype=dtype,
+            hierarchy_levels=pyramid_levels,
             **kwargs,
         )
         bossdb.upload()
+        if pyramid_levels > 1:
+            bossdb.downsample()
+
+
+class _VolumeMeta(NamedTuple):
+    url: str
+    downsampling: int
+    z_size: int
+    y_size: int
+    x_size: int
+    voxel_z_size: float
+    voxel_y_size: float
+    voxel_x_size: float
+    voxel_unit: str
+
+
+def _fetch_volume_meta(volume_key: dict) -> _VolumeMeta:
+    # One query for the url, resolution and extents, without fetching volume_data
+    return _VolumeMeta(*(Volume * Resolution & volume_key).fetch1(*_VolumeMeta._fields))
 
 
 @schema
@@ -307,8 +410,14 @@ class Segmentation(dj.Imported):
         cell_id : int
         """
 
+    class LabelPalette(dj.Part):
+        definition = """ # Original labels of compacted segmentation_data
+        -> master
+        ---
+        palette: longblob # original label of each index in segmentation_data
+        """
+
     def make(self, key):
-        # NOTE: convert seg data to unit8 instead of uint64
         (task_mode, seg_method, resolution_id, url, params) = (
             SegmentationTask * SegmentationParamset * Resolution & key
         ).fetch1(
@@ -331,9 +440,25 @@ class Segmentation(dj.Imported):
         session_key: Optional[dict] = None,
         **kwargs,
     ):
+        from .readers.bossdb import BossDBInterface  # isort: skip
+
         data = BossDBInterface(url, resolution=downsampling, session_key=session_key)
         data.load_data_into_element(table="Segmentation", **kwargs)
 
+    @classmethod
+    def fetch_labels(cls, key: dict) -> np.ndarray:
+        """Fetches segmentation_data with its original label values.
+
+        Args:
+            key (dict): A primary key of the Segmentation table.
+
+        Returns:
+            An array of original labels, restored from the palette if compacted.
+        """
+        data = (cls & key).fetch1("segmentation_data")
+        palette = cls.LabelPalette & key
+        return palette.fetch1("palette")[data] if palette else data
+
 
 @schema
 class CellMapping(dj.Computed):  # TODO: FIX cell table foreign key ref
@@ -435,5 +560,42 @@ class Connectome(dj.Imported):
         connectivity_strength: float # TODO: rename based on existing standards
         """
 
+    class EdgeArrays(dj.Part):
+        definition = """ # Connections as parallel arrays, sorted by pre_synaptic
+        -> master
+        ---
+        pre_synaptic: longblob # uint32 cell_id of each connection, ascending
+        post_synaptic: longblob # uint32 cell_id of each connection
+        connectivity_strength: longblob # float32 strength of each connection
+        """
+
     def make(self, key):
         raise NotImplementedError
+
+    @classmethod
+    def as_csr(cls, key: dict):
+        """Returns connectivity as a sparse matrix of pre- by post-synaptic cell_id.
+
+        Args:
+            key (dict): A primary key of the Connectome table.
+
+        Returns:
+            A scipy.sparse.csr_matrix of connectivity_strength, built from EdgeArrays.
+        """
+        from scipy.sparse import csr_matrix  # isort: skip
+
+        pre, post, strength = (cls.EdgeArrays & key).fetch1(
+            "pre_synaptic", "post_synaptic", "connectivity_strength"
+        )
+        n_cells = (
+            max(
+                int(pre.max()) if pre.size else -1,
+                int(post.max()) if post.size else -1,
+            )
+            + 1
+        )
+        if np.any(np.diff(pre) < 0):  # order rows so indptr can be binary searched
+            order = np.argsort(pre, kind="stable")
+            pre, post, strength = pre[order], post[order], strength[order]
+        indptr = np.searchsorted(pre, np.arange(n_cells + 1))
+        return csr_matrix((strength, post, indptr), shape=(n_cells, n_cells))